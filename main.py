@@ -1,12 +1,17 @@
 # main.py
 import os
-import re
-import json
+import asyncio
+import functools
+import logging
+import math
 import random
-from typing import Literal, Optional, Dict, Any
+import time
+from contextlib import asynccontextmanager
+from typing import Annotated, Literal, Optional, Dict, Any, List, Tuple, Union
 
-import requests
-from fastapi import FastAPI, HTTPException, status
+import httpx
+import orjson
+from fastapi import Body, FastAPI, HTTPException, Response, status
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
@@ -14,6 +19,8 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # کلید API و لینک ریدایرکت
 WEB_SERVICE_ID: Optional[str] = os.getenv("CHARGE_RESELLER_WEB_ID")
 REDIRECT_URL: str = "https://domain.com/charge.php"
@@ -24,8 +31,61 @@ API_ENDPOINTS: Dict[str, str] = {
     "pincode": "https://chr724.ir/services/v3/EasyCharge/BuyProduct"
 }
 
+# حداکثر تعداد درخواست‌ها در هر درخواست گروهی
+BATCH_MAX_ITEMS: int = 100
+
+# حداکثر درخواست‌های همزمان به API واسط از مسیر گروهی (مشترک بین همه درخواست‌های گروهی)
+BATCH_CONCURRENCY: int = 20
+
+# قطع موقت ارتباط با API واسط پس از خطاهای پیاپی
+BREAKER_FAIL_MAX: int = 5
+BREAKER_RESET_SECONDS: float = 30.0
+
+# نام ثابت Callback؛ API واسط پاسخ را به صورت JSONP برمی‌گرداند
+JSONP_CALLBACK: str = "callback"
+_JSONP_PREFIX: bytes = f"{JSONP_CALLBACK}(".encode()
+
+# پارامترهای ثابت درخواست به API واسط
+_BASE_PARAMS_TEMPLATE: Dict[str, Any] = {
+    "data[webserviceId]": WEB_SERVICE_ID,
+    "data[redirectUrl]": REDIRECT_URL,
+    "data[count]": 1,
+    "data[email]": "",
+    "data[packageId]": "",
+    "data[billId]": "",
+    "data[paymentId]": "",
+    "data[issuer]": "",
+    "data[paymentDetails]": "true",
+    "data[redirectToPage]": "true",
+    "data[scriptVersion]": "Script-fluent-1.7",
+    "data[firstOutputType]": "json",
+    "data[isTarabord]": "false",
+    "data[secondOutputType]": "get",
+    "data[ChargeKind]": "",
+    "callback": JSONP_CALLBACK,
+}
+
 OperatorType = Literal["MTN", "#MTN", "!MTN", "MCI", "WiMax", "RTL", "!RTL"]
 
+# نگاشت پیش‌شماره به اپراتور
+_PREFIX_MAP: Dict[str, str] = {
+    "090": "MTN",
+    "093": "MTN",
+    "091": "MCI",
+    "099": "MCI",
+    "094": "WiMax",
+}
+_RTL_PREFIXES = frozenset({"0920", "0921", "0922"})
+
+# نوع شارژ بر اساس (super, daemi)
+_MTN_TABLE: Dict[Tuple[bool, bool], str] = {
+    (False, False): "MTN",
+    (False, True): "#MTN",
+    (True, False): "!MTN",
+    (True, True): "!MTN",
+}
+_RTL_TABLE: Dict[bool, str] = {False: "RTL", True: "!RTL"}
+
 # --- مدل ها ---
 
 class ChargeRequest(BaseModel):
@@ -33,7 +93,7 @@ class ChargeRequest(BaseModel):
     مدل ورودی درخواست شارژ.
     """
     amount: int = Field(..., ge=2000, le=20000, description="مبلغ (۲۰۰۰ تا ۲۰۰۰۰ تومان)")
-    phone: str = Field(..., description="شماره موبایل ۱۱ رقمی (شروع با ۰۹)")
+    phone: str = Field(..., pattern=r"^09\d{9}$", description="شماره موبایل ۱۱ رقمی (شروع با ۰۹)")
     super: bool = False
     daemi: bool = False
     charge_type: Literal["direct", "pincode"]
@@ -41,83 +101,122 @@ class ChargeRequest(BaseModel):
 # --- توابع ---
 
 def _get_operator(phone: str, super: bool, daemi: bool) -> Optional[OperatorType]:
-    """تعیین اپراتور و نوع شارژ بر اساس پیش‌شماره."""
-
-    if re.fullmatch(r"09[03]\d{8}", phone):
-        if super:
-            return "!MTN"
-        elif daemi:
-            return "#MTN"
-        return "MTN"
-        
-    elif re.fullmatch(r"09[19]\d{8}", phone):
-        return "MCI"
-        
-    elif re.fullmatch(r"094\d{8}", phone):
-        return "WiMax"
-        
-    elif re.fullmatch(r"092[0-2]\d{7}", phone):
-        return "!RTL" if super else "RTL"
-        
-    return None
+    """
+    تعیین اپراتور و نوع شارژ بر اساس پیش‌شماره.
+    قالب شماره (۱۱ رقم، شروع با ۰۹) پیش‌تر توسط مدل ChargeRequest بررسی شده است.
+    """
+
+    if phone[:4] in _RTL_PREFIXES:
+        return _RTL_TABLE[super]
+
+    operator = _PREFIX_MAP.get(phone[:3])
+
+    if operator == "MTN":
+        return _MTN_TABLE[(super, daemi)]
+
+    return operator
+
+@functools.lru_cache(maxsize=256)
+def _product_id(operator: str, amount: int) -> str:
+    """شناسه محصول برای خرید کد شارژ (pincode)."""
+    return f"CC-{operator}-{amount}"
 
 def _prep_api_payload(request_data: Dict[str, Any]) -> Dict[str, Any]:
     """آماده‌سازی پارامترهای نهایی برای ارسال به API واسط."""
     
-    base_params = {
-        "data[webserviceId]": WEB_SERVICE_ID,
-        "data[redirectUrl]": REDIRECT_URL,
-        "data[count]": 1,
-        "data[email]": "",
-        "data[packageId]": "",
-        "data[billId]": "",
-        "data[paymentId]": "",
-        "data[issuer]": "",
-        "data[paymentDetails]": "true",
-        "data[redirectToPage]": "true",
-        "data[scriptVersion]": "Script-fluent-1.7",
-        "data[firstOutputType]": "json",
-        "data[isTarabord]": "false",
-        "data[secondOutputType]": "get",
-        "data[ChargeKind]": "",
-        "data[nonce]": random.randint(1111111111111, 9999999999999),
-    }
-
-    charge_params = {
-        "data[amount]": request_data["amount"],
-        "data[cellphone]": request_data["phone"],
-        "data[type]": request_data["operator"],
-    }
-
-    payload = {**base_params, **charge_params}
+    payload = _BASE_PARAMS_TEMPLATE.copy()
+    payload["data[nonce]"] = 1111111111111 + random.getrandbits(43)  # عدد ۱۳ رقمی
+    payload["data[amount]"] = request_data["amount"]
+    payload["data[cellphone]"] = request_data["phone"]
+    payload["data[type]"] = request_data["operator"]
 
     if request_data["type"] == "pincode":
-        payload["data[productId]"] = f"CC-{request_data['operator']}-{request_data['amount']}"
+        payload["data[productId]"] = _product_id(request_data["operator"], request_data["amount"])
     
     return payload
 
-# --- نمونه ---
+def _unwrap_jsonp(body: bytes) -> bytes:
+    """حذف Callback + پرانتزها برای تبدیل JSONP به JSON (بدون تبدیل به رشته)."""
 
-app = FastAPI(
-    title="Type Shit",
-    description="سرویس پردازش درخواست‌های شارژ موبایل.",
-    version="1.0.0",
-)
+    body = body.strip()
+    if body.startswith(_JSONP_PREFIX) and body.endswith(b")"):
+        return body[len(_JSONP_PREFIX):-1]
 
-# --- پایان نمونه ---
+    return body
 
-@app.post("/charge", status_code=status.HTTP_200_OK)
-async def create_charge(request: ChargeRequest):
+class _CircuitOpenError(Exception):
+    """مدار باز است و درخواست بدون ارسال به API واسط رد می‌شود."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+class _CircuitBreaker:
     """
-    درخواست شارژ را دریافت، اعتبارسنجی و به API واسط ارسال می‌کند.
+    قطع موقت ارتباط با API واسط پس از خطاهای پیاپی.
+    پس از پایان زمان قطع، یک درخواست آزمایشی عبور می‌کند و موفقیت آن مدار را می‌بندد.
     """
-    
-    if not WEB_SERVICE_ID:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="خطای سرور: کلید وب‌سرویس (WEB_SERVICE_ID) تنظیم نشده است."
-        )
 
+    def __init__(self, fail_max: int, reset_timeout: float):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+
+    def before_call(self) -> None:
+        if self._opened_at is None:
+            return
+
+        remaining = self._opened_at + self.reset_timeout - time.monotonic()
+        if remaining > 0:
+            raise _CircuitOpenError(remaining)
+
+        # درخواست آزمایشی؛ بقیه تا مشخص شدن نتیجه آن منتظر می‌مانند
+        self._opened_at = time.monotonic()
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._failures >= self.fail_max:
+            self._opened_at = time.monotonic()
+
+_breaker = _CircuitBreaker(BREAKER_FAIL_MAX, BREAKER_RESET_SECONDS)
+
+def _is_upstream_failure(e: httpx.HTTPError) -> bool:
+    """
+    آیا خطا نشانه خرابی API واسط است؟
+    خطاهای 4xx و پر بودن صف اتصال‌های خود سرویس (PoolTimeout) خنثی‌اند:
+    نه شمارنده خطا را افزایش می‌دهند و نه آن را صفر می‌کنند.
+    """
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return not isinstance(e, httpx.PoolTimeout)
+
+async def _fetch_upstream(client: httpx.AsyncClient, api_url: str, params: Dict[str, Any]) -> bytes:
+    """دریافت بدنه پاسخ API واسط و ثبت نتیجه در Circuit Breaker."""
+
+    _breaker.before_call()
+    try:
+        async with client.stream("GET", api_url, params=params) as response:
+            response.raise_for_status()
+            body = await response.aread()
+    except httpx.HTTPError as e:
+        if _is_upstream_failure(e):
+            _breaker.record_failure()
+        raise
+
+    _breaker.record_success()
+    return body
+
+async def _process_charge(client: httpx.AsyncClient, request: ChargeRequest) -> bytes:
+    """
+    اعتبارسنجی یک درخواست شارژ و ارسال آن به API واسط.
+    خروجی، بدنه JSON پاسخ API واسط است که بدون تبدیل مجدد برگردانده می‌شود.
+    """
+    
     operator = _get_operator(
         request.phone, 
         request.super,
@@ -144,35 +243,130 @@ async def create_charge(request: ChargeRequest):
         "type": request.charge_type
     }
     
-    # ساخت Callback
-    random_suffix = "".join(str(random.randint(0, 9)) for _ in range(15))
-    callback_name = f"callback_{random_suffix}"
-    
     params = _prep_api_payload(request_data_for_payload)
-    params["callback"] = callback_name
     
     try:
-        response = requests.get(api_url, params=params, timeout=10)
-        response.raise_for_status() 
-        
-        # حذف Callback + پرانتزها برای تبدیل JSONP به JSON
-        response_text_clean = response.text.replace(f"{callback_name}", "").strip().lstrip('(').rstrip(')')
-            
-        result = json.loads(response_text_clean)
-        return result
+        body = await _fetch_upstream(client, api_url, params)
+
+        payload = _unwrap_jsonp(body)
+        orjson.loads(payload)  # فقط اعتبارسنجی JSON
+        return payload
 
-    except requests.exceptions.Timeout:
+    except _CircuitOpenError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="ارتباط با API به دلیل خطاهای پیاپی موقتا قطع شده است.",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    except httpx.TimeoutException:
         raise HTTPException(
             status_code=status.HTTP_504_GATEWAY_TIMEOUT,
             detail="درخواست API منقضی شد."
         )
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPStatusError as e:
+        # پیام خطای httpx شامل آدرس کامل و کلید وب‌سرویس است و لاگ نمی‌شود
+        logger.warning("خطا در ارتباط با API: وضعیت %s", e.response.status_code)
+        retry_after = e.response.headers.get("Retry-After")
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail=f"خطا در ارتباط با API: {e}"
+            detail="خطا در ارتباط با API.",
+            headers={"Retry-After": retry_after} if retry_after else None,
         )
-    except json.JSONDecodeError:
+    except httpx.HTTPError as e:
+        logger.warning("خطا در ارتباط با API: %s", type(e).__name__)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="خطا در ارتباط با API."
+        )
+    except orjson.JSONDecodeError:
         raise HTTPException(
             status_code=status.HTTP_502_BAD_GATEWAY,
             detail="خطا در پردازش پاسخ JSON."
         )
+
+def _batch_item(result: Union[bytes, BaseException]) -> bytes:
+    """تبدیل نتیجه یا خطای یک مورد از درخواست گروهی به JSON."""
+
+    if isinstance(result, bytes):
+        return result
+
+    if isinstance(result, HTTPException):
+        status_code, detail = result.status_code, result.detail
+        retry_after = (result.headers or {}).get("Retry-After")
+    elif isinstance(result, Exception):
+        logger.error("خطای پیش‌بینی‌نشده در درخواست گروهی: %s", type(result).__name__)
+        status_code, detail, retry_after = 500, "خطای داخلی سرور.", None
+    else:
+        raise result
+
+    return orjson.dumps({
+        "status_code": status_code,
+        "detail": detail,
+        "retry_after": retry_after,
+    })
+
+# --- نمونه ---
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    """
+    بررسی کلید وب‌سرویس هنگام راه‌اندازی، ساخت و بستن کلاینت HTTP مشترک
+    برای استفاده مجدد از اتصال‌ها به API واسط، و ساخت محدودکننده مسیر گروهی.
+    """
+
+    if not WEB_SERVICE_ID:
+        raise RuntimeError("کلید وب‌سرویس (CHARGE_RESELLER_WEB_ID) تنظیم نشده است.")
+
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,
+        timeout=httpx.Timeout(10.0, connect=2.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=100,
+            max_connections=200,
+            keepalive_expiry=60,
+        ),
+    )
+    # ساخت Semaphore داخل حلقه رویداد سرور
+    app.state.batch_limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+app = FastAPI(
+    title="Type Shit",
+    description="سرویس پردازش درخواست‌های شارژ موبایل.",
+    version="1.0.0",
+    lifespan=_lifespan,
+)
+
+# --- پایان نمونه ---
+
+@app.post("/charge", status_code=status.HTTP_200_OK)
+async def create_charge(request: ChargeRequest):
+    """
+    درخواست شارژ را دریافت، اعتبارسنجی و به API واسط ارسال می‌کند.
+    """
+    
+    payload = await _process_charge(app.state.http, request)
+    return Response(content=payload, media_type="application/json")
+
+@app.post("/charge/batch", status_code=status.HTTP_200_OK)
+async def create_charges(
+    batch: Annotated[List[ChargeRequest], Body(max_length=BATCH_MAX_ITEMS)],
+):
+    """
+    چند درخواست شارژ را به صورت همزمان به API واسط ارسال می‌کند.
+    نتیجه هر درخواست (یا خطای آن) به همان ترتیب ورودی برگردانده می‌شود.
+    """
+    
+    async def _charge_one(request: ChargeRequest) -> bytes:
+        async with app.state.batch_limit:
+            return await _process_charge(app.state.http, request)
+
+    results = await asyncio.gather(*(_charge_one(r) for r in batch), return_exceptions=True)
+    return Response(
+        content=b"[" + b",".join(_batch_item(r) for r in results) + b"]",
+        media_type="application/json",
+    )
@@ -0,0 +1,221 @@
+# test_main.py
+import asyncio
+import os
+
+import httpx
+import orjson
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("CHARGE_RESELLER_WEB_ID", "test-web-id")
+
+import main
+
+UPSTREAM_URL = "https://upstream.test/charge"
+OK_BODY = b'callback({"ok": true})'
+
+# --- ابزارها ---
+
+class _FakeClock:
+    """جایگزین ماژول time برای کنترل زمان Circuit Breaker."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = _FakeClock()
+    monkeypatch.setattr(main, "time", fake)
+    return fake
+
+@pytest.fixture
+def breaker(monkeypatch, clock):
+    fresh = main._CircuitBreaker(fail_max=3, reset_timeout=30.0)
+    monkeypatch.setattr(main, "_breaker", fresh)
+    return fresh
+
+def _respond(status_code: int, content: bytes = b"", headers=None):
+    return lambda request: httpx.Response(status_code, content=content, headers=headers)
+
+def _raise(exc_type):
+    def handler(request):
+        raise exc_type("upstream error", request=request)
+    return handler
+
+def _fetch(handler):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await main._fetch_upstream(client, UPSTREAM_URL, {})
+    return asyncio.run(run())
+
+def _charge(handler):
+    request = main.ChargeRequest(amount=5000, phone="09123456789", charge_type="direct")
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await main._process_charge(client, request)
+    return asyncio.run(run())
+
+def _fail(times: int):
+    for _ in range(times):
+        with pytest.raises(httpx.HTTPStatusError):
+            _fetch(_respond(500))
+
+# --- Circuit Breaker ---
+
+def test_breaker_opens_after_fail_max_failures(breaker):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(500)
+
+    for _ in range(3):
+        with pytest.raises(httpx.HTTPStatusError):
+            _fetch(handler)
+
+    with pytest.raises(main._CircuitOpenError):
+        _fetch(handler)
+    assert len(calls) == 3
+
+def test_open_circuit_reports_remaining_time(breaker, clock):
+    _fail(3)
+    clock.now += 21
+
+    with pytest.raises(HTTPException) as info:
+        _charge(_respond(200, OK_BODY))
+
+    assert info.value.status_code == 503
+    assert info.value.headers == {"Retry-After": "9"}
+
+def test_client_errors_and_pool_timeouts_are_neutral(breaker):
+    _fail(2)
+
+    for _ in range(5):
+        with pytest.raises(httpx.HTTPStatusError):
+            _fetch(_respond(404))
+        with pytest.raises(httpx.PoolTimeout):
+            _fetch(_raise(httpx.PoolTimeout))
+
+    # نه شمارنده را افزایش داده‌اند و نه صفر کرده‌اند
+    breaker.before_call()
+    _fail(1)
+    with pytest.raises(main._CircuitOpenError):
+        breaker.before_call()
+
+def test_single_trial_call_after_reset_window(breaker, clock):
+    _fail(3)
+    clock.now += 30
+
+    breaker.before_call()
+    with pytest.raises(main._CircuitOpenError):
+        breaker.before_call()
+
+def test_successful_trial_closes_circuit(breaker, clock):
+    _fail(3)
+    clock.now += 30
+
+    assert _fetch(_respond(200, OK_BODY)) == OK_BODY
+    breaker.before_call()
+    breaker.before_call()
+
+def test_failed_trial_reopens_circuit(breaker, clock):
+    _fail(3)
+    clock.now += 30
+
+    with pytest.raises(httpx.HTTPStatusError):
+        _fetch(_respond(500))
+    with pytest.raises(main._CircuitOpenError) as info:
+        breaker.before_call()
+    assert info.value.retry_after == 30.0
+
+def test_tripping_timeout_keeps_504(breaker):
+    _fail(2)
+
+    with pytest.raises(HTTPException) as info:
+        _charge(_raise(httpx.ReadTimeout))
+    assert info.value.status_code == 504
+
+    with pytest.raises(HTTPException) as info:
+        _charge(_respond(200, OK_BODY))
+    assert info.value.status_code == 503
+    assert info.value.headers == {"Retry-After": "30"}
+
+# --- درخواست گروهی ---
+
+@pytest.fixture
+def batch_api(monkeypatch, breaker):
+    """ساخت TestClient که کلاینت HTTP مشترک آن به API واسط شبیه‌سازی‌شده وصل است."""
+
+    real_client = httpx.AsyncClient
+
+    def start(handler):
+        monkeypatch.setattr(
+            httpx,
+            "AsyncClient",
+            lambda **kwargs: real_client(transport=httpx.MockTransport(handler), **kwargs),
+        )
+        return TestClient(main.app)
+
+    return start
+
+def _item(phone: str) -> dict:
+    return {"amount": 5000, "phone": phone, "charge_type": "direct"}
+
+def test_batch_keeps_input_order(batch_api):
+    async def handler(request):
+        phone = request.url.params["data[cellphone]"]
+        # پاسخ موارد اول دیرتر می‌رسد
+        await asyncio.sleep(0.01 * (9 - int(phone[-1])))
+        return httpx.Response(200, content=b"callback(" + orjson.dumps({"phone": phone}) + b")")
+
+    phones = [f"0912345678{i}" for i in range(10)]
+    with batch_api(handler) as client:
+        response = client.post("/charge/batch", json=[_item(p) for p in phones])
+
+    assert response.status_code == 200
+    assert response.json() == [{"phone": p} for p in phones]
+
+def test_batch_error_items(batch_api):
+    def handler(request):
+        phone = request.url.params["data[cellphone]"]
+        if phone == "09123456780":
+            return httpx.Response(503, headers={"Retry-After": "7"})
+        if phone == "09123456781":
+            raise httpx.StreamError("stream consumed")
+        return httpx.Response(200, content=OK_BODY)
+
+    batch = [
+        _item("09123456789"),
+        _item("09512345678"),
+        _item("09123456780"),
+        _item("09123456781"),
+    ]
+    with batch_api(handler) as client:
+        response = client.post("/charge/batch", json=batch)
+
+    assert response.status_code == 200
+    assert response.json() == [
+        {"ok": True},
+        {"status_code": 400, "detail": "اپراتور برای این شماره تلفن یافت نشد.", "retry_after": None},
+        {"status_code": 503, "detail": "خطا در ارتباط با API.", "retry_after": "7"},
+        {"status_code": 500, "detail": "خطای داخلی سرور.", "retry_after": None},
+    ]
+
+def test_batch_rejects_more_than_max_items(batch_api):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, content=OK_BODY)
+
+    batch = [_item("09123456789")] * (main.BATCH_MAX_ITEMS + 1)
+    with batch_api(handler) as client:
+        response = client.post("/charge/batch", json=batch)
+
+    assert response.status_code == 422
+    assert calls == []